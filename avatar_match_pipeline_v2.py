@@ -1,17 +1,149 @@
 import os
 import json
+import logging
+import asyncio
+import hashlib
+import threading
 import time
 import tempfile
 from typing import List, Dict, Any, Tuple, Optional
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
-from PIL import Image
+from urllib.parse import urlsplit
+from PIL import Image, ImageDraw, ImageFont
 import base64
 import io
 import random
+from collections import OrderedDict
 
 from avatar_service import AvatarService
-from in_memory_llm_service import InMemoryLLMService
+from in_memory_llm_service import InMemoryLLMService, get_encode_buffer
+
+logger = logging.getLogger(__name__)
+
+# Up to this many candidates are compared in one request instead of further tournament rounds
+SINGLE_SHOT_MAX_CANDIDATES = 16
+
+# Longest side of images sent to the LLM, matching InMemoryLLMService.MAX_IMAGE_DIM;
+# larger images only cost extra upload bytes and image tokens
+LLM_IMAGE_SIZE = InMemoryLLMService.MAX_IMAGE_DIM
+
+def prepare_image_for_llm(image: Image.Image, max_size: int = LLM_IMAGE_SIZE) -> Image.Image:
+    """Convert an image to RGB and downscale it to fit within max_size x max_size, keeping aspect ratio"""
+    # Only copy pixels when something changes; an RGB image that already fits is used as is
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    if max(image.size) > max_size:
+        # resize returns a new image, so the caller's image is never modified
+        scale = max_size / max(image.size)
+        new_size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(new_size, Image.LANCZOS)
+    return image
+
+def decode_image_for_llm(data: bytes, max_size: int = LLM_IMAGE_SIZE) -> Image.Image:
+    """Decode encoded image bytes and resize them for the LLM"""
+    image = Image.open(io.BytesIO(data))
+    # Let libjpeg downscale during decode (no-op for non-JPEG); keep 2x headroom for the LANCZOS pass
+    image.draft('RGB', (max_size * 2, max_size * 2))
+    return prepare_image_for_llm(image, max_size)
+
+def decode_and_resize_image(data: bytes, max_size: int = LLM_IMAGE_SIZE) -> Tuple[Tuple[int, int], bytes]:
+    """Decode and resize image bytes in a worker process, returning (size, raw RGB bytes) for cheap pickling"""
+    image = decode_image_for_llm(data, max_size)
+    return image.size, image.tobytes()
+
+# Below this many images, decoding inline is cheaper than handing the bytes to worker processes
+PROCESS_DECODE_MIN_IMAGES = 64
+
+# Worker pool shared across runs, so processes are started (and the module re-imported) only once
+_decode_pool: Optional[ProcessPoolExecutor] = None
+_decode_pool_lock = threading.Lock()
+
+def get_decode_pool() -> ProcessPoolExecutor:
+    """Get the shared decode pool, creating it on first use"""
+    global _decode_pool
+    with _decode_pool_lock:
+        if _decode_pool is None:
+            _decode_pool = ProcessPoolExecutor(max_workers=os.cpu_count() or 1)
+        return _decode_pool
+
+def decode_images_in_processes(raw_images: Dict[str, bytes]) -> Dict[str, Image.Image]:
+    """Decode and resize downloaded avatar bytes, in worker processes when there are enough of them"""
+    decoded_images = {}
+    if len(raw_images) < PROCESS_DECODE_MIN_IMAGES:
+        for avatar_id, data in raw_images.items():
+            try:
+                decoded_images[avatar_id] = decode_image_for_llm(data)
+            except Exception as e:
+                logger.warning("Error decoding avatar %s: %s", avatar_id, e)
+        return decoded_images
+    future_to_avatar_id = {
+        get_decode_pool().submit(decode_and_resize_image, data): avatar_id
+        for avatar_id, data in raw_images.items()
+    }
+    for future in as_completed(future_to_avatar_id):
+        avatar_id = future_to_avatar_id[future]
+        try:
+            size, pixels = future.result()
+            decoded_images[avatar_id] = Image.frombytes('RGB', size, pixels)
+        except Exception as e:
+            logger.warning("Error decoding avatar %s: %s", avatar_id, e)
+    return decoded_images
+
+# On-disk cache of gender/child detections, keyed by user image content
+GENDER_CHILD_CACHE_DIR = Path('.cache') / 'gender_child'
+
+def image_content_key(image: Image.Image) -> str:
+    """Hash an image's mode, size and pixels (BLAKE2b is fast on multi-MB buffers)"""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(f"{image.mode}:{image.size}".encode())
+    hasher.update(image.tobytes())
+    return hasher.hexdigest()
+
+def get_gender_child_info_cached(llm_service: InMemoryLLMService, user_image: Image.Image) -> Dict[str, str]:
+    """Detect gender and child status, reusing the stored result for a previously seen user image"""
+    cache_path = GENDER_CHILD_CACHE_DIR / f"{image_content_key(user_image)}.json"
+    try:
+        cached_info = json.loads(cache_path.read_text())
+        logger.debug("Using cached gender/child data: %s", cached_info)
+        return cached_info
+    except (OSError, ValueError):
+        pass
+    
+    gender_child_info = llm_service.get_gender_child_info_from_image(user_image)
+    
+    # Failed detections come back as "unknown", so only cache real answers
+    if gender_child_info.get("gender", "unknown") != "unknown":
+        try:
+            GENDER_CHILD_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            tmp_path = cache_path.with_suffix('.tmp')
+            tmp_path.write_text(json.dumps(gender_child_info))
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            logger.warning("Could not cache gender/child data: %s", e)
+    
+    return gender_child_info
+
+# Services shared across runs so metadata, indices and HTTP clients are built once
+_avatar_service: Optional[AvatarService] = None
+_llm_service: Optional[InMemoryLLMService] = None
+_services_lock = threading.Lock()
+
+def get_avatar_service() -> AvatarService:
+    """Get the shared AvatarService, creating it on first use"""
+    global _avatar_service
+    with _services_lock:
+        if _avatar_service is None:
+            _avatar_service = AvatarService()
+        return _avatar_service
+
+def get_llm_service() -> InMemoryLLMService:
+    """Get the shared InMemoryLLMService, creating it on first use"""
+    global _llm_service
+    with _services_lock:
+        if _llm_service is None:
+            _llm_service = InMemoryLLMService()
+        return _llm_service
 
 def create_batches(items: List[Any], batch_size: int = 6) -> List[List[Any]]:
     """Create batches from a list of items"""
@@ -20,11 +152,23 @@ def create_batches(items: List[Any], batch_size: int = 6) -> List[List[Any]]:
         batches.append(items[i:i + batch_size])
     return batches
 
-def image_to_base64(image: Image.Image) -> str:
+def image_to_jpeg_bytes(image: Image.Image, quality: int = 85) -> bytes:
+    """Encode PIL Image as JPEG bytes"""
+    buffer = get_encode_buffer()
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    image.save(buffer, format='JPEG', quality=quality, optimize=False)
+    return buffer.getvalue()
+
+def image_to_base64(image: Image.Image, format: str = 'JPEG', quality: int = 85) -> str:
     """Convert PIL Image to base64 string"""
-    buffer = io.BytesIO()
-    image.save(buffer, format='PNG')
-    img_str = base64.b64encode(buffer.getvalue()).decode()
+    if format == 'JPEG':
+        img_bytes = image_to_jpeg_bytes(image, quality)
+    else:
+        buffer = get_encode_buffer()
+        image.save(buffer, format=format)
+        img_bytes = buffer.getvalue()
+    img_str = base64.b64encode(img_bytes).decode()
     return img_str
 
 def base64_to_image(base64_str: str) -> Image.Image:
@@ -32,107 +176,370 @@ def base64_to_image(base64_str: str) -> Image.Image:
     img_data = base64.b64decode(base64_str)
     return Image.open(io.BytesIO(img_data))
 
+STRIP_HEIGHT = 60
+_FONT_PATHS = [
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts", "DejaVuSans-Bold.ttf"),
+    "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf",
+    "/System/Library/Fonts/Arial.ttf",
+]
+_FONT = None
+_strip_cache: Dict[Tuple[int, str], Image.Image] = {}
+# Number of numbered avatar encodings kept across runs (about 35 KB each)
+JPEG_CACHE_SIZE = 256
+# LRU of (avatar_id, strip number) -> JPEG bytes of the numbered avatar
+_jpeg_cache: "OrderedDict[Tuple[str, int], bytes]" = OrderedDict()
+_jpeg_cache_lock = threading.Lock()
+# Per-thread compositing canvases, reused across encodes instead of allocating one per avatar
+_canvas_local = threading.local()
+
+def get_strip_font() -> ImageFont.ImageFont:
+    """Load the strip font once and reuse it for every strip"""
+    global _FONT
+    if _FONT is None:
+        for font_path in _FONT_PATHS:
+            try:
+                _FONT = ImageFont.truetype(font_path, 28)
+                break
+            except OSError:
+                continue
+        else:
+            _FONT = ImageFont.load_default()
+    return _FONT
+
+def get_text_strip(width: int, text: str) -> Image.Image:
+    """Get a cached white strip of the given width with centered text"""
+    key = (width, text)
+    strip = _strip_cache.get(key)
+    if strip is None:
+        strip = Image.new('RGB', (width, STRIP_HEIGHT), (255, 255, 255))
+        draw = ImageDraw.Draw(strip)
+        font = get_strip_font()
+        bbox = draw.textbbox((0, 0), text, font=font)
+        text_x = (width - (bbox[2] - bbox[0])) // 2
+        text_y = (STRIP_HEIGHT - (bbox[3] - bbox[1])) // 2
+        draw.text((text_x, text_y), text, fill=(0, 0, 0), font=font)
+        _strip_cache[key] = strip
+    return strip
+
+def add_text_strip_to_image(image: Image.Image, text: str) -> Image.Image:
+    """Composite a cached text strip below an image"""
+    width, height = image.size
+    new_image = Image.new('RGB', (width, height + STRIP_HEIGHT), (255, 255, 255))
+    new_image.paste(image, (0, 0))
+    new_image.paste(get_text_strip(width, text), (0, height))
+    return new_image
+
+def get_strip_canvas(width: int, height: int) -> Image.Image:
+    """Get this thread's reusable canvas for compositing an image of the given size with a strip"""
+    canvases = getattr(_canvas_local, 'canvases', None)
+    if canvases is None:
+        canvases = _canvas_local.canvases = {}
+    size = (width, height + STRIP_HEIGHT)
+    canvas = canvases.get(size)
+    if canvas is None:
+        canvas = canvases[size] = Image.new('RGB', size)
+    return canvas
+
 def add_numbered_strip_to_image(image: Image.Image, number: int) -> Image.Image:
     """Add a numbered strip to an image (in-memory version, 60px strip)"""
-    img_with_number = image.copy()
-    width, height = img_with_number.size
-    new_height = height + 60  # Increased strip height
-    new_image = Image.new('RGB', (width, new_height), (255, 255, 255))
-    new_image.paste(img_with_number, (0, 0))
-    from PIL import ImageDraw, ImageFont
-    draw = ImageDraw.Draw(new_image)
-    try:
-        font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 28)
-    except:
-        try:
-            font = ImageFont.truetype("/System/Library/Fonts/Arial.ttf", 28)
-        except:
-            font = ImageFont.load_default()
-    text = str(number)
-    bbox = draw.textbbox((0, 0), text, font=font)
-    text_width = bbox[2] - bbox[0]
-    text_x = (width - text_width) // 2
-    text_y = height + (60 - (bbox[3] - bbox[1])) // 2
-    draw.text((text_x, text_y), text, fill=(0, 0, 0), font=font)
-    return new_image
+    return add_text_strip_to_image(image, str(number))
 
 def add_label_strip_to_image(image: Image.Image, label: str) -> Image.Image:
     """Add a labeled strip to an image (in-memory version, 60px strip)"""
-    img_with_label = image.copy()
-    width, height = img_with_label.size
-    new_height = height + 60
-    new_image = Image.new('RGB', (width, new_height), (255, 255, 255))
-    new_image.paste(img_with_label, (0, 0))
-    from PIL import ImageDraw, ImageFont
-    draw = ImageDraw.Draw(new_image)
-    try:
-        font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 28)
-    except:
-        try:
-            font = ImageFont.truetype("/System/Library/Fonts/Arial.ttf", 28)
-        except:
-            font = ImageFont.load_default()
-    bbox = draw.textbbox((0, 0), label, font=font)
-    text_width = bbox[2] - bbox[0]
-    text_x = (width - text_width) // 2
-    text_y = height + (60 - (bbox[3] - bbox[1])) // 2
-    draw.text((text_x, text_y), label, fill=(0, 0, 0), font=font)
-    return new_image
+    return add_text_strip_to_image(image, label)
+
+def get_cached_jpeg(key: Tuple[str, int]) -> Optional[bytes]:
+    """Look up a numbered avatar encoding, marking it most recently used"""
+    with _jpeg_cache_lock:
+        encoded_image = _jpeg_cache.get(key)
+        if encoded_image is not None:
+            _jpeg_cache.move_to_end(key)
+        return encoded_image
 
-def process_batch_in_memory(llm_service: InMemoryLLMService, avatar_service: AvatarService, 
-                           user_image: Image.Image, batch_avatar_ids: List[str], 
-                           avatar_images_cache: Dict[str, Image.Image]) -> Tuple[str, int]:
-    """Process a single batch using in-memory images and return the best match avatar ID and its index"""
-    batch_images = []
+def store_cached_jpeg(key: Tuple[str, int], encoded_image: bytes):
+    """Cache a numbered avatar encoding, evicting the least recently used entry when full"""
+    with _jpeg_cache_lock:
+        _jpeg_cache[key] = encoded_image
+        _jpeg_cache.move_to_end(key)
+        if len(_jpeg_cache) > JPEG_CACHE_SIZE:
+            _jpeg_cache.popitem(last=False)
+
+def encode_numbered_batch(batch_avatar_ids: List[str], avatar_images_cache: Dict[str, Image.Image]) -> List[bytes]:
+    """Add numbered strips to a batch of avatars and return their JPEG bytes, reusing earlier encodings"""
+    numbered_batch_images = []
+    for i, avatar_id in enumerate(batch_avatar_ids, 1):
+        key = (avatar_id, i)
+        encoded_image = get_cached_jpeg(key)
+        if encoded_image is None:
+            # The avatar and strip together cover the whole canvas, so nothing stale survives
+            image = avatar_images_cache[avatar_id]
+            width, height = image.size
+            numbered_image = get_strip_canvas(width, height)
+            numbered_image.paste(image, (0, 0))
+            numbered_image.paste(get_text_strip(width, str(i)), (0, height))
+            encoded_image = image_to_jpeg_bytes(numbered_image)
+            store_cached_jpeg(key, encoded_image)
+        numbered_batch_images.append(encoded_image)
+    return numbered_batch_images
+
+async def process_batch_in_memory_async(llm_service: InMemoryLLMService, labeled_user_jpeg: bytes,
+                                        batch_avatar_ids: List[str],
+                                        avatar_images_cache: Dict[str, Image.Image],
+                                        top_k: int = 1) -> Tuple[List[str], List[int]]:
+    """Process a single batch using in-memory images and return the top_k best match avatar IDs and their indices, best first"""
+    # Candidates that all survive the batch need no LLM call
+    if len(batch_avatar_ids) <= top_k:
+        return list(batch_avatar_ids), list(range(len(batch_avatar_ids)))
     valid_avatar_ids = []
     for avatar_id in batch_avatar_ids:
         if avatar_id in avatar_images_cache:
-            batch_images.append(avatar_images_cache[avatar_id])
             valid_avatar_ids.append(avatar_id)
         else:
-            print(f"Warning: Avatar {avatar_id} not found in cache, skipping")
-    if not batch_images:
-        return batch_avatar_ids[0], 0
-    # Randomize avatar images and ids together
-    combined = list(zip(batch_images, valid_avatar_ids))
-    random.shuffle(combined)
-    batch_images, valid_avatar_ids = zip(*combined)
-    batch_images = list(batch_images)
-    valid_avatar_ids = list(valid_avatar_ids)
-    # Add numbered strips to randomized avatar images
-    numbered_batch_images = []
-    for i, image in enumerate(batch_images, 1):
-        numbered_image = add_numbered_strip_to_image(image, i)
-        numbered_batch_images.append(numbered_image)
-    # Add 'Real Photo' strip to user image
-    user_image_with_label = add_label_strip_to_image(user_image, "Real Photo")
-    # Get best match from LLM using numbered in-memory images
-    best_match_image, winner_index = llm_service.get_best_match_in_batch(user_image_with_label, numbered_batch_images)
-    # Map winner index back to correct avatar ID
-    winner_avatar_id = valid_avatar_ids[winner_index]
-    return winner_avatar_id, winner_index
-
-def find_best_avatar_match_v2(user_image_path: str, batch_size: int = 6) -> Dict[str, Any]:
+            logger.warning("Avatar %s not found in cache, skipping", avatar_id)
+    if not valid_avatar_ids:
+        return [batch_avatar_ids[0]], [0]
+    # Encode off the event loop so other batches' requests stay in flight
+    loop = asyncio.get_running_loop()
+    numbered_batch_images = await loop.run_in_executor(
+        None, encode_numbered_batch, valid_avatar_ids, avatar_images_cache)
+    # Get best match(es) from LLM using numbered in-memory images
+    if top_k == 1:
+        best_match_image, winner_index = await llm_service.get_best_match_in_batch_async(
+            labeled_user_jpeg, numbered_batch_images)
+        winner_indices = [winner_index]
+    else:
+        winner_indices = await llm_service.get_top_k_in_batch_async(
+            labeled_user_jpeg, numbered_batch_images, k=top_k)
+    # Map winner indices back to correct avatar IDs
+    winner_avatar_ids = [valid_avatar_ids[index] for index in winner_indices]
+    return winner_avatar_ids, winner_indices
+
+def validate_tournament_settings(batch_size: int, top_k: int):
+    """Reject settings under which batches can't shrink the candidate pool"""
+    if batch_size < 2:
+        raise ValueError(f"Batch size must be at least 2, got {batch_size}")
+    if not 1 <= top_k < batch_size:
+        raise ValueError(f"top_k must be between 1 and batch_size - 1, got {top_k}")
+
+def plan_tournament_rounds(num_candidates: int, batch_size: int, top_k: int = 1) -> List[Tuple[int, int, int]]:
+    """
+    Work out the shape of every tournament round up front
+    
+    Every batch advances min(top_k, len(batch)) avatars, even when it falls back
+    after an error, so the number of candidates in each round is known before
+    any LLM call is made.
+    
+    Returns:
+        List of (num_candidates, round_batch_size, round_top_k) for each round
+        
+    Raises:
+        ValueError: If batch_size < 2 or top_k is not between 1 and batch_size - 1,
+            since every round would then keep all of its candidates
+    """
+    validate_tournament_settings(batch_size, top_k)
+    plan = []
+    while num_candidates > 1:
+        # A single batch when all candidates fit one request
+        round_batch_size = batch_size
+        if num_candidates <= SINGLE_SHOT_MAX_CANDIDATES:
+            round_batch_size = max(batch_size, num_candidates)
+        batch_sizes = [len(batch) for batch in create_batches(list(range(num_candidates)), round_batch_size)]
+        round_top_k = 1 if len(batch_sizes) == 1 else top_k
+        plan.append((num_candidates, round_batch_size, round_top_k))
+        num_candidates = sum(min(round_top_k, size) for size in batch_sizes)
+    return plan
+
+async def run_tournament_async(llm_service: InMemoryLLMService, labeled_user_jpeg: bytes,
+                               candidate_ids: List[str], avatar_images_cache: Dict[str, Image.Image],
+                               batch_size: int, top_k: int = 1) -> Tuple[List[str], List[Dict[str, Any]], int]:
+    """
+    Run tournament-style elimination over the cached avatars
+    
+    While more than batch_size candidates remain, the top_k best of every batch
+    advance; once the candidates fit in a single batch, one final pick is made.
+    Once no more than SINGLE_SHOT_MAX_CANDIDATES remain, they are all compared in
+    that one final request rather than over further serial rounds.
+    With top_k > 1 larger batches can be used without losing close runners-up.
+    
+    All batches are sent to the LLM concurrently on a single event loop,
+    throttled only when the process would exceed LLM_REQUESTS_PER_MINUTE. Rounds are
+    pipelined: a batch of the next round is sent as soon as the earlier batches
+    that feed it have finished, without waiting for the rest of its round.
+    Avatar order within each batch is shuffled with a per-round seed, so runs are
+    reproducible and the strip-number encodings cached from earlier runs are reused.
+    
+    Returns:
+        Tuple of (remaining_candidates, elimination_history, total_rounds)
+    """
+    plan = plan_tournament_rounds(len(candidate_ids), batch_size, top_k)
+    
+    # Per round: candidates known so far (in batch order), batches sent, batch results,
+    # and how many leading batches have finished
+    round_candidates: List[List[str]] = [list(candidate_ids)] + [[] for _ in plan]
+    round_batches: List[List[List[str]]] = [[] for _ in plan]
+    round_results: List[Dict[int, Tuple[List[str], List[int]]]] = [{} for _ in plan]
+    round_finished: List[int] = [0 for _ in plan]
+    # Batches whose winners are a fallback rather than an LLM pick
+    round_fallbacks: List[set] = [set() for _ in plan]
+    round_rngs = [random.Random(round_index + 1) for round_index in range(len(plan))]
+    pending: Dict[asyncio.Task, Tuple[int, int]] = {}
+    
+    def dispatch_ready_batches(round_index: int):
+        """Send every batch of the round whose candidates are all known, in batch order"""
+        num_candidates, round_batch_size, round_top_k = plan[round_index]
+        candidates = round_candidates[round_index]
+        batches = round_batches[round_index]
+        while len(batches) * round_batch_size < num_candidates:
+            start = len(batches) * round_batch_size
+            end = min(start + round_batch_size, num_candidates)
+            if len(candidates) < end:
+                break
+            if not batches:
+                num_batches = (num_candidates + round_batch_size - 1) // round_batch_size
+                logger.debug("=== ROUND %s ===", round_index + 1)
+                logger.debug("Processing %s candidates", num_candidates)
+                logger.debug("Created %s batches of size %s, keeping top %s of each", num_batches, round_batch_size, round_top_k)
+            # Randomize avatar order within each batch, deterministically per round
+            batch = candidates[start:end]
+            round_rngs[round_index].shuffle(batch)
+            task = asyncio.ensure_future(
+                process_batch_in_memory_async(llm_service, labeled_user_jpeg, batch, avatar_images_cache,
+                                              top_k=round_top_k)
+            )
+            pending[task] = (round_index, len(batches))
+            batches.append(batch)
+    
+    if plan:
+        dispatch_ready_batches(0)
+    
+    while pending:
+        done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            round_index, batch_index = pending.pop(task)
+            batch = round_batches[round_index][batch_index]
+            round_top_k = plan[round_index][2]
+            if task.exception() is not None:
+                logger.warning("Batch processing failed: %s", task.exception())
+                # Fallback to first avatars in batch
+                batch_winner_indices = list(range(min(round_top_k, len(batch))))
+                batch_result = ([batch[index] for index in batch_winner_indices], batch_winner_indices)
+                round_fallbacks[round_index].add(batch_index)
+            else:
+                batch_result = task.result()
+                logger.debug("Batch winners: %s (indices %s)", batch_result[0], batch_result[1])
+            results = round_results[round_index]
+            results[batch_index] = batch_result
+            
+            # Winners feed the next round in batch order, so advance only past the finished leading batches
+            advanced = False
+            while round_finished[round_index] in results:
+                round_candidates[round_index + 1].extend(results[round_finished[round_index]][0])
+                round_finished[round_index] += 1
+                advanced = True
+            if advanced and round_index + 1 < len(plan):
+                dispatch_ready_batches(round_index + 1)
+    
+    # Record elimination for every round
+    elimination_history = []
+    for round_index, batches in enumerate(round_batches):
+        batch_details = []
+        for batch_index, batch in enumerate(batches):
+            batch_winner_ids, batch_winner_indices = round_results[round_index][batch_index]
+            batch_details.append({
+                "batch_avatar_ids": batch,
+                "winner_id": batch_winner_ids[0],
+                "winner_index": batch_winner_indices[0],
+                "winner_ids": batch_winner_ids,
+                "winner_indices": batch_winner_indices,
+                "fallback": batch_index in round_fallbacks[round_index]
+            })
+        elimination_history.append({
+            "round": round_index + 1,
+            "candidates": round_candidates[round_index],
+            "winners": round_candidates[round_index + 1],
+            "batch_details": batch_details
+        })
+    
+    return round_candidates[-1], elimination_history, len(plan)
+
+def encode_avatar_images(avatar_ids: List[str], avatar_images_cache: Dict[str, Image.Image]) -> List[bytes]:
+    """Encode avatars as JPEG bytes, without strips"""
+    return [image_to_jpeg_bytes(avatar_images_cache[avatar_id]) for avatar_id in avatar_ids]
+
+async def run_pairwise_scoring_async(llm_service: InMemoryLLMService, labeled_user_jpeg: bytes,
+                                     candidate_ids: List[str],
+                                     avatar_images_cache: Dict[str, Image.Image]) -> Tuple[List[str], List[Dict[str, Any]], int]:
+    """
+    Score every avatar against the user image once and keep the highest scoring one
+    
+    A score depends only on the user/avatar pair, not on which batch the avatar
+    is in, so all candidates are scored in a single round of parallel requests
+    rather than being rescored in every tournament round. Avatars whose scoring
+    request failed are left out; if any failed, the round is marked as a fallback.
+    
+    Returns:
+        Tuple of (remaining_candidates, elimination_history, total_rounds)
+    """
+    if len(candidate_ids) <= 1:
+        return list(candidate_ids), [], 0
+    # Encode off the event loop, then send every scoring request at once
+    loop = asyncio.get_running_loop()
+    avatar_jpegs = await loop.run_in_executor(None, encode_avatar_images, candidate_ids, avatar_images_cache)
+    scores = await llm_service.get_scores_async(labeled_user_jpeg, avatar_jpegs)
+    scored_indices = [index for index, score in enumerate(scores) if score is not None]
+    if scored_indices:
+        # Ties keep candidate order
+        winner_index = max(scored_indices, key=lambda index: scores[index])
+    else:
+        logger.warning("All scoring requests failed, falling back to first avatar")
+        winner_index = 0
+    winner_id = candidate_ids[winner_index]
+    logger.debug("Pairwise winner: %s (index %s)", winner_id, winner_index)
+    elimination_history = [{
+        "round": 1,
+        "candidates": list(candidate_ids),
+        "winners": [winner_id],
+        "batch_details": [{
+            "batch_avatar_ids": list(candidate_ids),
+            "winner_id": winner_id,
+            "winner_index": winner_index,
+            "winner_ids": [winner_id],
+            "winner_indices": [winner_index],
+            "scores": scores,
+            "fallback": len(scored_indices) < len(scores)
+        }]
+    }]
+    return [winner_id], elimination_history, 1
+
+def find_best_avatar_match_v2(user_image_path: Optional[str] = None, batch_size: int = 6, top_k: int = 1,
+                              pairwise_scoring: bool = False,
+                              llm_service: Optional[InMemoryLLMService] = None,
+                              avatar_service: Optional[AvatarService] = None,
+                              user_image: Optional[Image.Image] = None) -> Dict[str, Any]:
     """Main pipeline to find the best avatar match using tournament-style elimination with optimized in-memory processing"""
     
-    # Initialize services
-    llm_service = InMemoryLLMService()
-    avatar_service = AvatarService()
+    # Use the given services, or the shared ones
+    llm_service = llm_service or get_llm_service()
+    avatar_service = avatar_service or get_avatar_service()
     
-    # Load user image
+    # Load user image, unless it was passed in memory
     try:
-        user_image = Image.open(user_image_path)
-        print(f"Loaded user image: {user_image.size}")
+        user_image = prepare_image_for_llm(user_image if user_image is not None else Image.open(user_image_path))
+        logger.debug("Loaded user image: %s", user_image.size)
     except Exception as e:
         return {"error": f"Failed to load user image: {e}"}
     
+    # The labeled user image is identical for every batch, so build and encode it once
+    get_strip_font()
+    labeled_user_jpeg = image_to_jpeg_bytes(add_label_strip_to_image(user_image, "Real Photo"))
+    
     # First, detect gender and child status from user image
-    print("Detecting gender and child status from user image...")
-    gender_child_info = llm_service.get_gender_child_info_from_image(user_image)
+    logger.debug("Detecting gender and child status from user image...")
+    gender_child_info = get_gender_child_info_cached(llm_service, user_image)
     gender = gender_child_info.get("gender", "unknown")
     is_child = gender_child_info.get("child", "false") == "true"
     
-    print(f"Detected: gender={gender}, child={is_child}")
+    logger.info("Detected: gender=%s, child=%s", gender, is_child)
     
     # Filter avatars based on detected characteristics
     age_group = "child" if is_child else "adult"
@@ -140,118 +547,66 @@ def find_best_avatar_match_v2(user_image_path: str, batch_size: int = 6) -> Dict
     if gender == "unknown":
         # If gender detection fails, use all avatars of the detected age group
         avatar_ids = avatar_service.get_avatar_ids_by_criteria(age_group=age_group)
-        print(f"Gender detection failed, using all {age_group} avatars")
+        logger.warning("Gender detection failed, using all %s avatars", age_group)
     else:
         # Create filter based on gender and child status
         avatar_ids = avatar_service.get_avatar_ids_by_criteria(gender=gender, age_group=age_group)
-        print(f"Filtering avatars: gender={gender}, age_group={age_group}")
+        logger.info("Filtering avatars: gender=%s, age_group=%s", gender, age_group)
     
     if not avatar_ids:
         return {"error": f"No avatar images found matching criteria: gender={gender}, age_group={age_group}"}
     
-    print(f"Found {len(avatar_ids)} matching avatars to process")
-    print(f"User image: {user_image_path}")
-    print(f"Batch size: {batch_size}")
+    logger.info("Found %s matching avatars to process", len(avatar_ids))
+    logger.info("User image: %s", user_image_path or 'in memory')
+    logger.info("Batch size: %s", batch_size)
+    logger.info("Survivors per batch: %s", top_k)
+    logger.info("Pairwise scoring: %s", pairwise_scoring)
     
     # OPTIMIZATION: Pre-download all filtered avatars once and cache them in memory
-    print("Pre-downloading all filtered avatars...")
+    logger.debug("Pre-downloading all filtered avatars...")
     start_download_time = time.time()
     
-    # Download all images in parallel for better performance
-    avatar_images_cache = {}
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        # Submit all download tasks
-        future_to_avatar_id = {}
-        for avatar_id in avatar_ids:
-            metadata = avatar_service.get_avatar_metadata(avatar_id)
-            if metadata and metadata.get('public_url'):
-                future_to_avatar_id[executor.submit(avatar_service.download_image_from_url, metadata['public_url'])] = avatar_id
-            else:
-                print(f"No public URL found for avatar {avatar_id}, skipping")
-        
-        # Collect results as they complete
-        for future in as_completed(future_to_avatar_id):
-            avatar_id = future_to_avatar_id[future]
-            try:
-                image = future.result()
-                if image:
-                    avatar_images_cache[avatar_id] = image
-                    print(f"Downloaded avatar {avatar_id}")
-                else:
-                    print(f"Failed to download avatar {avatar_id}")
-            except Exception as e:
-                print(f"Error downloading avatar {avatar_id}: {e}")
+    # Group downloads by host so pooled keep-alive connections are reused back-to-back
+    def avatar_host(avatar_id: str) -> str:
+        metadata = avatar_service.get_avatar_metadata(avatar_id) or {}
+        return urlsplit(metadata.get('public_url') or '').netloc
+    avatar_ids = sorted(avatar_ids, key=avatar_host)
+    
+    # Download all raw image bytes concurrently on one event loop (network-bound)
+    raw_images = asyncio.run(avatar_service.download_avatar_bytes_async(avatar_ids))
+    
+    # Decode and resize (CPU-bound, so large sets go to worker processes to sidestep the GIL)
+    avatar_images_cache = decode_images_in_processes(raw_images)
     
     download_time = time.time() - start_download_time
-    print(f"Downloaded {len(avatar_images_cache)} avatars in {download_time:.2f} seconds")
+    logger.info("Downloaded %s avatars in %.2f seconds", len(avatar_images_cache), download_time)
     
     if not avatar_images_cache:
         return {"error": "Failed to download any avatar images"}
     
     # Tournament-style elimination using cached images
-    current_round = 1
-    current_candidates = list(avatar_images_cache.keys())  # Use only downloaded avatars
-    elimination_history = []
-    
-    while len(current_candidates) > 1:
-        print(f"\n=== ROUND {current_round} ===")
-        print(f"Processing {len(current_candidates)} candidates")
-        
-        # Create batches with specified batch size
-        batches = create_batches(current_candidates, batch_size=batch_size)
-        print(f"Created {len(batches)} batches of size {batch_size}")
-        
-        # Process batches in parallel using cached images
-        winners = []
-        batch_details = []
-        with ThreadPoolExecutor(max_workers=min(len(batches), 10)) as executor:
-            # Submit all batch processing tasks
-            future_to_batch = {
-                executor.submit(process_batch_in_memory, llm_service, avatar_service, 
-                              user_image, batch, avatar_images_cache): batch 
-                for batch in batches
-            }
-            
-            # Collect results as they complete
-            for future in as_completed(future_to_batch):
-                batch = future_to_batch[future]
-                try:
-                    winner_id, winner_index = future.result()
-                    winners.append(winner_id)
-                    batch_details.append({
-                        "batch_avatar_ids": batch,
-                        "winner_id": winner_id,
-                        "winner_index": winner_index
-                    })
-                    print(f"Batch winner: {winner_id} (index {winner_index})")
-                except Exception as e:
-                    print(f"Batch processing failed: {e}")
-                    # Fallback to first avatar in batch
-                    winners.append(batch[0])
-                    batch_details.append({
-                        "batch_avatar_ids": batch,
-                        "winner_id": batch[0],
-                        "winner_index": 0
-                    })
-        
-        # Record elimination for this round
-        elimination_history.append({
-            "round": current_round,
-            "candidates": current_candidates,
-            "winners": winners,
-            "batch_details": batch_details
-        })
-        
-        # Update candidates for next round
-        current_candidates = winners
-        current_round += 1
-        
-        # Add delay to avoid rate limiting
-        time.sleep(1)
+    candidate_ids = [avatar_id for avatar_id in avatar_ids if avatar_id in avatar_images_cache]  # Use only downloaded avatars
+    if pairwise_scoring:
+        current_candidates, elimination_history, total_rounds = asyncio.run(
+            run_pairwise_scoring_async(llm_service, labeled_user_jpeg, candidate_ids, avatar_images_cache)
+        )
+    else:
+        current_candidates, elimination_history, total_rounds = asyncio.run(
+            run_tournament_async(llm_service, labeled_user_jpeg, candidate_ids, avatar_images_cache, batch_size, top_k)
+        )
     
     # Final result
     best_match_id = current_candidates[0] if current_candidates else None
     
+    # A result built on a failed gender detection or fallback batch picks may not be the real best match
+    degraded = gender == "unknown" or any(
+        batch_detail["fallback"]
+        for round_data in elimination_history
+        for batch_detail in round_data["batch_details"]
+    )
+    if degraded:
+        logger.warning("Result is degraded by LLM fallbacks")
+    
     # Get metadata for the best match
     best_match_metadata = avatar_service.get_avatar_metadata(best_match_id) if best_match_id else None
     
@@ -260,9 +615,12 @@ def find_best_avatar_match_v2(user_image_path: str, batch_size: int = 6) -> Dict
             "avatar_id": best_match_id,
             "metadata": best_match_metadata
         },
-        "total_rounds": current_round - 1,
+        "total_rounds": total_rounds,
         "total_avatars_processed": len(avatar_ids),
         "batch_size": batch_size,
+        "top_k": top_k,
+        "pairwise_scoring": pairwise_scoring,
+        "degraded": degraded,
         "elimination_history": elimination_history,
         "user_image_path": user_image_path,
         "user_characteristics": {
@@ -277,34 +635,47 @@ def find_best_avatar_match_v2(user_image_path: str, batch_size: int = 6) -> Dict
         }
     }
     
-    print(f"\n=== FINAL RESULT ===")
-    print(f"Best match ID: {best_match_id}")
-    print(f"Total rounds: {current_round - 1}")
-    print(f"Download time: {download_time:.2f}s")
-    print(f"Avatars downloaded: {len(avatar_images_cache)}/{len(avatar_ids)}")
+    logger.info("=== FINAL RESULT ===")
+    logger.info("Best match ID: %s", best_match_id)
+    logger.info("Total rounds: %s", total_rounds)
+    logger.info("Download time: %.2fs", download_time)
+    logger.info("Avatars downloaded: %s/%s", len(avatar_images_cache), len(avatar_ids))
     
     return result
 
-def run_avatar_matching_v2(user_image_path: str, batch_size: int = 6) -> Dict[str, Any]:
+def run_avatar_matching_v2(user_image_path: Optional[str] = None, batch_size: int = 6, top_k: int = 1,
+                           pairwise_scoring: bool = False,
+                           llm_service: Optional[InMemoryLLMService] = None,
+                           avatar_service: Optional[AvatarService] = None,
+                           user_image: Optional[Image.Image] = None) -> Dict[str, Any]:
     """
     Run the new avatar matching pipeline with URL downloads
     
     Args:
-        user_image_path: Path to the user's image
+        user_image_path: Path to the user's image, not needed when user_image is given
         batch_size: Number of avatars to compare at once
+        top_k: Number of avatars advancing from each batch before the final round
+        pairwise_scoring: Score every avatar once in its own parallel request instead of running the tournament
+        llm_service: Optional LLM service to use, defaults to the shared instance
+        avatar_service: Optional avatar service to use, defaults to the shared instance
+        user_image: Optional in-memory PIL image of the user, used instead of reading user_image_path
         
     Returns:
         Dictionary containing:
         - best_match_avatar_id: ID of the best matching avatar
-        - user_image_path: Path to the user's image
+        - degraded: True if gender detection or any comparison fell back after an LLM failure
+        - user_image_path: Path to the user's image (None for an in-memory image)
         - metadata: Additional information about the matching process
     """
     # Validate inputs
-    if not os.path.exists(user_image_path):
+    if user_image is None and not (user_image_path and os.path.exists(user_image_path)):
         raise FileNotFoundError(f"User image not found: {user_image_path}")
+    validate_tournament_settings(batch_size, top_k)
     
     # Run the pipeline
-    result = find_best_avatar_match_v2(user_image_path, batch_size)
+    result = find_best_avatar_match_v2(user_image_path, batch_size, top_k, pairwise_scoring,
+                                       llm_service=llm_service, avatar_service=avatar_service,
+                                       user_image=user_image)
     
     # Check for errors
     if "error" in result:
@@ -314,11 +685,14 @@ def run_avatar_matching_v2(user_image_path: str, batch_size: int = 6) -> Dict[st
     return {
         "best_match_avatar_id": result["best_match"]["avatar_id"],
         "best_match_metadata": result["best_match"]["metadata"],
+        "degraded": result["degraded"],
         "user_image_path": user_image_path,
         "metadata": {
             "total_rounds": result["total_rounds"],
             "total_avatars_processed": result["total_avatars_processed"],
-            "batch_size": result["batch_size"]
+            "batch_size": result["batch_size"],
+            "top_k": result["top_k"],
+            "pairwise_scoring": result["pairwise_scoring"]
         },
         "elimination_history": result["elimination_history"],
         "user_characteristics": result["user_characteristics"],
@@ -360,4 +734,5 @@ def test_pipeline():
         traceback.print_exc()
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     test_pipeline() 
\ No newline at end of file
@@ -1,38 +1,78 @@
 import json
+import logging
+import asyncio
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import io
 from PIL import Image
 from typing import List, Dict, Any, Optional
 import os
+from collections import defaultdict
 from pathlib import Path
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+logger = logging.getLogger(__name__)
+
 class AvatarService:
     """Service for managing avatar metadata and downloading images from URLs"""
     
     def __init__(self, metadata_file: str = 'avatar_metadata.jsonl'):
         self.metadata_file = metadata_file
         self.avatars_metadata = self._load_metadata()
+        self._build_indices()
         self._image_cache = {}  # Cache for downloaded images
+        
+        # Pooled keep-alive session shared by all download threads
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=32,
+            pool_maxsize=32,
+            max_retries=Retry(total=2, backoff_factor=0.2)
+        )
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
     
     def _load_metadata(self) -> List[Dict[str, Any]]:
         """Load avatar metadata from JSONL file"""
         avatars = []
         if os.path.exists(self.metadata_file):
-            with open(self.metadata_file, 'r') as f:
-                for line in f:
-                    if line.strip():
-                        avatars.append(json.loads(line.strip()))
+            with open(self.metadata_file, 'rb') as f:
+                data = f.read()
+            for line in data.splitlines():
+                if line.strip():
+                    avatars.append(_json_loads(line))
         return avatars
     
+    def _build_indices(self):
+        """Index metadata by avatar ID and by (gender, age_group) for O(1) lookups"""
+        self._by_id = {a['avatar_id']: a for a in self.avatars_metadata}
+        self._by_gender_age = defaultdict(list)
+        for avatar in self.avatars_metadata:
+            key = (avatar.get('gender', '').lower(), avatar.get('age_group', '').lower())
+            self._by_gender_age[key].append(avatar)
+    
     def get_avatars_by_criteria(self, gender: Optional[str] = None, age_group: Optional[str] = None) -> List[Dict[str, Any]]:
         """Filter avatars by gender and age group"""
-        filtered_avatars = self.avatars_metadata
+        if not (gender and gender != "unknown") and not age_group:
+            return self.avatars_metadata
         
-        if gender and gender != "unknown":
-            filtered_avatars = [a for a in filtered_avatars if a.get('gender', '').lower() == gender.lower()]
+        gender = gender.lower() if gender and gender != "unknown" else None
+        age_group = age_group.lower() if age_group else None
         
-        if age_group:
-            filtered_avatars = [a for a in filtered_avatars if a.get('age_group', '').lower() == age_group.lower()]
+        filtered_avatars = []
+        for (avatar_gender, avatar_age_group), avatars in self._by_gender_age.items():
+            if gender is not None and avatar_gender != gender:
+                continue
+            if age_group is not None and avatar_age_group != age_group:
+                continue
+            filtered_avatars.extend(avatars)
         
         return filtered_avatars
     
@@ -41,18 +81,74 @@ class AvatarService:
         filtered_avatars = self.get_avatars_by_criteria(gender, age_group)
         return [avatar['avatar_id'] for avatar in filtered_avatars]
     
-    def download_image_from_url(self, url: str) -> Optional[Image.Image]:
-        """Download image from URL and return PIL Image"""
+    def download_bytes_from_url(self, url: str) -> Optional[bytes]:
+        """Download image from URL and return the raw encoded bytes"""
         try:
-            response = requests.get(url, timeout=10)
+            response = self._session.get(url, timeout=10)
             response.raise_for_status()
+            return response.content
             
+        except Exception as e:
+            logger.warning("Error downloading image from %s: %s", url, e)
+            return None
+    
+    async def download_bytes_from_url_async(self, session: aiohttp.ClientSession, url: str) -> Optional[bytes]:
+        """Download image from URL on an aiohttp session and return the raw encoded bytes"""
+        try:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                return await response.read()
+            
+        except Exception as e:
+            logger.warning("Error downloading image from %s: %s", url, e)
+            return None
+    
+    async def download_avatar_bytes_async(self, avatar_ids: List[str]) -> Dict[str, bytes]:
+        """
+        Download raw image bytes for many avatars concurrently on one event loop
+        
+        Args:
+            avatar_ids: Avatar IDs to download
+            
+        Returns:
+            Dictionary mapping avatar ID to raw encoded image bytes, for successful downloads only
+        """
+        urls = {}
+        for avatar_id in avatar_ids:
+            avatar_metadata = self._by_id.get(avatar_id)
+            if avatar_metadata and avatar_metadata.get('public_url'):
+                urls[avatar_id] = avatar_metadata['public_url']
+            else:
+                logger.warning("No public URL found for avatar %s, skipping", avatar_id)
+        
+        connector = aiohttp.TCPConnector(limit=64, ttl_dns_cache=300)
+        timeout = aiohttp.ClientTimeout(total=10)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            results = await asyncio.gather(
+                *[self.download_bytes_from_url_async(session, url) for url in urls.values()]
+            )
+        
+        downloaded = {}
+        for avatar_id, data in zip(urls, results):
+            if data:
+                downloaded[avatar_id] = data
+                logger.debug("Downloaded avatar %s", avatar_id)
+            else:
+                logger.warning("Failed to download avatar %s", avatar_id)
+        return downloaded
+    
+    def download_image_from_url(self, url: str) -> Optional[Image.Image]:
+        """Download image from URL and return PIL Image"""
+        data = self.download_bytes_from_url(url)
+        if data is None:
+            return None
+        try:
             # Convert to PIL Image
-            image = Image.open(io.BytesIO(response.content))
+            image = Image.open(io.BytesIO(data))
             return image
             
         except Exception as e:
-            print(f"Error downloading image from {url}: {e}")
+            logger.warning("Error decoding image from %s: %s", url, e)
             return None
     
     def download_batch_images(self, avatar_ids: List[str]) -> Dict[str, Image.Image]:
@@ -61,10 +157,10 @@ class AvatarService:
         
         for avatar_id in avatar_ids:
             # Find avatar metadata
-            avatar_metadata = next((a for a in self.avatars_metadata if a['avatar_id'] == avatar_id), None)
+            avatar_metadata = self._by_id.get(avatar_id)
             
             if not avatar_metadata:
-                print(f"Avatar metadata not found for ID: {avatar_id}")
+                logger.warning("Avatar metadata not found for ID: %s", avatar_id)
                 continue
             
             # Check cache first
@@ -75,7 +171,7 @@ class AvatarService:
             # Download from URL
             url = avatar_metadata.get('public_url')
             if not url:
-                print(f"No public URL found for avatar ID: {avatar_id}")
+                logger.warning("No public URL found for avatar ID: %s", avatar_id)
                 continue
             
             image = self.download_image_from_url(url)
@@ -83,13 +179,13 @@ class AvatarService:
                 downloaded_images[avatar_id] = image
                 self._image_cache[avatar_id] = image  # Cache the image
             else:
-                print(f"Failed to download image for avatar ID: {avatar_id}")
+                logger.warning("Failed to download image for avatar ID: %s", avatar_id)
         
         return downloaded_images
     
     def get_avatar_metadata(self, avatar_id: str) -> Optional[Dict[str, Any]]:
         """Get metadata for a specific avatar ID"""
-        return next((a for a in self.avatars_metadata if a['avatar_id'] == avatar_id), None)
+        return self._by_id.get(avatar_id)
     
     def get_total_avatars(self) -> int:
         """Get total number of avatars"""
@@ -155,4 +251,5 @@ def test_avatar_service():
             print(f"  {avatar_id}: {image.size}")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     test_avatar_service() 
\ No newline at end of file
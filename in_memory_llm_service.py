@@ -1,20 +1,129 @@
+import asyncio
 import base64
 import os
 import re
 import json
 import io
-from typing import List, Dict, Any, Tuple, Optional
+import logging
+import hashlib
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from typing import List, Dict, Any, Tuple, Optional, Union
 from google import genai
 from google.genai import types
 from dotenv import load_dotenv
 from PIL import Image
 
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+logger = logging.getLogger(__name__)
+
+# Per-thread encode buffers, shared by the service and the pipeline
+_encode_local = threading.local()
+
+def get_encode_buffer() -> io.BytesIO:
+    """Get this thread's reusable encode buffer, emptied"""
+    buffer = getattr(_encode_local, 'buffer', None)
+    if buffer is None:
+        buffer = _encode_local.buffer = io.BytesIO()
+    buffer.seek(0)
+    buffer.truncate()
+    return buffer
+
+# Response-parsing patterns, compiled once
+_JSON_OBJECT_RE = re.compile(r'\{[^}]*\}')
+_NUMBER_RE = re.compile(r'\b(\d+)\b')
+_DIGITS_RE = re.compile(r'\d+')
+# An integer with its sign, so a negative free-text score isn't read as positive
+_SIGNED_INT_RE = re.compile(r'-?\d+')
+# A number followed by something else, i.e. the number is complete
+_COMPLETE_NUMBER_RE = re.compile(r'\d+\D')
+
+# Values normalize_boolean_string treats as true (True also matches 1)
+_TRUE_VALUES = frozenset({"true", "1", "yes", "on", True})
+
+# Structured output schemas, so responses come back as small JSON objects instead of free text
+_CHOICE_SCHEMA = types.Schema(
+    type="OBJECT",
+    properties={"choice": types.Schema(type="INTEGER")},
+    required=["choice"],
+)
+_CHOICES_SCHEMA = types.Schema(
+    type="OBJECT",
+    properties={"choices": types.Schema(type="ARRAY", items=types.Schema(type="INTEGER"))},
+    required=["choices"],
+)
+_SCORE_SCHEMA = types.Schema(
+    type="OBJECT",
+    properties={"score": types.Schema(type="INTEGER")},
+    required=["score"],
+)
+_GENDER_CHILD_SCHEMA = types.Schema(
+    type="OBJECT",
+    properties={
+        "gender": types.Schema(type="STRING", enum=["male", "female"]),
+        "child": types.Schema(type="BOOLEAN"),
+    },
+    required=["gender", "child"],
+)
+
 # Load environment variables from .env file
 load_dotenv()
 
+# Gemini request quota; requests only wait when the process would exceed it
+LLM_REQUESTS_PER_MINUTE = int(os.environ.get("LLM_REQUESTS_PER_MINUTE", "60"))
+
+class RateLimiter:
+    """Leaky-bucket rate limiter that only blocks callers once max_rate requests are in flight per time_period"""
+    
+    def __init__(self, max_rate: float, time_period: float = 60.0):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self._rate_per_second = max_rate / time_period
+        self._level = 0.0
+        self._last_check = time.monotonic()
+        # A thread lock rather than an asyncio one, so threads and separate event loops share the bucket
+        self._lock = threading.Lock()
+    
+    def _reserve(self) -> float:
+        """Take capacity for one request, returning how long the caller must wait before sending it"""
+        with self._lock:
+            now = time.monotonic()
+            self._level = max(0.0, self._level - (now - self._last_check) * self._rate_per_second)
+            self._last_check = now
+            wait = max(0.0, (self._level + 1 - self.max_rate) / self._rate_per_second)
+            self._level += 1
+            return wait
+    
+    def acquire(self):
+        """Block until there is capacity for one more request"""
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+    
+    async def acquire_async(self):
+        """Wait, without blocking the event loop, until there is capacity for one more request"""
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+# The quota belongs to the API key, so every service instance and run draws from one bucket
+_rate_limiter = RateLimiter(LLM_REQUESTS_PER_MINUTE, 60)
+
 class InMemoryLLMService:
     """Service class to handle all LLM interactions for avatar matching with in-memory images"""
     
+    # Longest side of images sent to the model; the faces don't need more detail than this
+    MAX_IMAGE_DIM = 512
+    # Number of gender/child responses kept in the perceptual-hash cache
+    RESPONSE_CACHE_SIZE = 256
+    
     def __init__(self, api_key: Optional[str] = None):
         """
         Initialize the LLM response service
@@ -28,21 +137,123 @@ class InMemoryLLMService:
         
         self.client = genai.Client(api_key=self.api_key)
         self.model_name = "gemini-2.5-flash"
+        # Lighter model for the short, schema-constrained avatar selection and scoring calls
+        self.selection_model_name = "gemini-2.5-flash-lite"
+        self.jpeg_quality = 85
+        
+        # JPEG bytes per live PIL image, keyed by id() since PIL images are unhashable
+        self._jpeg_cache: Dict[int, bytes] = {}
+        
+        # LRU of (perceptual hash, prompt hash) -> response text for gender/child detection
+        self._response_cache: "OrderedDict[Tuple[int, str], str]" = OrderedDict()
+        self._response_cache_lock = threading.Lock()
+        
+        # Open the API connection in the background so the first real request skips the handshake
+        threading.Thread(target=self._prewarm_connection, name="genai-prewarm", daemon=True).start()
     
-    def encode_pil_image_to_base64(self, image: Image.Image, format: str = 'JPEG') -> str:
-        """Convert PIL Image to base64 string"""
-        img_byte_arr = io.BytesIO()
+    def _prewarm_connection(self):
+        """Make a lightweight request to establish the client's pooled connection"""
+        try:
+            self.client.models.get(model=self.model_name)
+        except Exception as e:
+            logger.debug("Connection pre-warm failed: %s", e)
+    
+    def _encode_pil_image(self, image: Image.Image, format: str = 'JPEG') -> bytes:
+        """Encode PIL Image to bytes in the given format"""
+        img_byte_arr = get_encode_buffer()
+        
+        # Downscale before encoding so neither upload bytes nor image tokens are wasted
+        if max(image.size) > self.MAX_IMAGE_DIM:
+            image = image.copy()
+            image.thumbnail((self.MAX_IMAGE_DIM, self.MAX_IMAGE_DIM), Image.Resampling.BILINEAR)
         
         # Convert RGBA to RGB if needed for JPEG
         if image.mode == 'RGBA' and format == 'JPEG':
             # Create a white background
             rgb_image = Image.new('RGB', image.size, (255, 255, 255))
-            rgb_image.paste(image, mask=image.split()[-1])  # Use alpha channel as mask
+            rgb_image.paste(image, mask=image)  # An RGBA mask uses its alpha band, no split() copies needed
             image = rgb_image
+        elif format == 'JPEG' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
         
-        image.save(img_byte_arr, format=format)
-        img_byte_arr = img_byte_arr.getvalue()
-        return base64.b64encode(img_byte_arr).decode('utf-8')
+        if format == 'JPEG':
+            # Single pass encode: no Huffman optimization or progressive scans
+            image.save(img_byte_arr, format=format, quality=self.jpeg_quality,
+                       optimize=False, progressive=False)
+        else:
+            image.save(img_byte_arr, format=format)
+        return img_byte_arr.getvalue()
+    
+    def encode_pil_image_to_jpeg_bytes(self, image: Image.Image) -> bytes:
+        """
+        Convert PIL Image to JPEG bytes, memoized for as long as the image is alive
+        
+        Args:
+            image: PIL Image to encode
+            
+        Returns:
+            JPEG-encoded bytes
+        """
+        key = id(image)
+        jpeg_bytes = self._jpeg_cache.get(key)
+        if jpeg_bytes is None:
+            jpeg_bytes = self._encode_pil_image(image)
+            self._jpeg_cache[key] = jpeg_bytes
+            # Drop the entry when the image is garbage collected so ids are never reused stale
+            weakref.finalize(image, self._jpeg_cache.pop, key, None)
+        return jpeg_bytes
+    
+    def encode_pil_image_to_base64(self, image: Image.Image, format: str = 'JPEG') -> str:
+        """Convert PIL Image to base64 string"""
+        if format == 'JPEG':
+            img_bytes = self.encode_pil_image_to_jpeg_bytes(image)
+        else:
+            img_bytes = self._encode_pil_image(image, format)
+        return base64.b64encode(img_bytes).decode('utf-8')
+    
+    def close(self):
+        """Release cached encodings and responses"""
+        self._jpeg_cache.clear()
+        with self._response_cache_lock:
+            self._response_cache.clear()
+    
+    def perceptual_hash(self, image: Image.Image) -> int:
+        """
+        Compute a 64-bit difference hash (dHash) of an image
+        
+        Re-encoded or slightly resized copies of the same photo hash alike,
+        so the hash identifies the photo rather than its exact bytes.
+        
+        Args:
+            image: PIL Image to hash
+            
+        Returns:
+            64-bit integer hash
+        """
+        pixels = list(image.convert('L').resize((9, 8), Image.Resampling.BILINEAR).getdata())
+        bits = 0
+        for row in range(8):
+            for col in range(8):
+                left = pixels[row * 9 + col]
+                right = pixels[row * 9 + col + 1]
+                bits = (bits << 1) | (left > right)
+        return bits
+    
+    def _get_cached_response(self, key: Tuple[int, str]) -> Optional[str]:
+        """Look up a cached response, marking it most recently used"""
+        with self._response_cache_lock:
+            response_text = self._response_cache.get(key)
+            if response_text is not None:
+                self._response_cache.move_to_end(key)
+            return response_text
+    
+    def _store_cached_response(self, key: Tuple[int, str], response_text: str):
+        """Cache a response, evicting the least recently used entry when full"""
+        with self._response_cache_lock:
+            self._response_cache[key] = response_text
+            self._response_cache.move_to_end(key)
+            if len(self._response_cache) > self.RESPONSE_CACHE_SIZE:
+                self._response_cache.popitem(last=False)
     
     def create_batch_comparison_prompt(self, batch_size: int) -> str:
         """Create the prompt for comparing user image with a batch of avatars"""
@@ -57,7 +268,39 @@ You must choose one answer. The realism doesn't matter - we are trying to find t
 
 IMPORTANT: Number the images starting from 1 (not 0). So the first avatar image is number 1, the second is number 2, and so on up to number {batch_size}.
 
-Respond with ONLY the number (1-{batch_size}) of the best matching image, nothing else."""
+Return the number (1-{batch_size}) of the best matching image as "choice"."""
+        
+        return prompt
+    
+    def create_top_k_comparison_prompt(self, batch_size: int, k: int) -> str:
+        """Create the prompt for picking the k best avatars from a batch"""
+        
+        prompt = f"""Given the first image (the real person), which {k} images from the remaining {batch_size} images are the best matches to it?
+
+Focus on facial features like hair style, facial hair (beard, mustache, stubble), facial accessories (glasses, earrings, piercings), and skin tone also enthnicity (asian/black/brown/white)
+
+Ignore clothing, background, or other non-facial elements.
+
+You must choose exactly {k} different images. The realism doesn't matter - we are trying to find the best avatars for the first real photo.
+
+IMPORTANT: Number the images starting from 1 (not 0). So the first avatar image is number 1, the second is number 2, and so on up to number {batch_size}.
+
+Return the {k} numbers (1-{batch_size}) of the best matching images as "choices", best first."""
+        
+        return prompt
+    
+    def create_pair_scoring_prompt(self) -> str:
+        """Create the prompt for scoring how well a single avatar matches the user image"""
+        
+        prompt = """Given the first image (the real person), how well does the second image (an avatar) match it?
+
+Focus on facial features like hair style, facial hair (beard, mustache, stubble), facial accessories (glasses, earrings, piercings), and skin tone also enthnicity (asian/black/brown/white)
+
+Ignore clothing, background, or other non-facial elements. The realism doesn't matter - we are trying to find the best avatar for the first real photo.
+
+Return a similarity score from 0 (no resemblance) to 100 (perfect match).
+
+Return the score (0-100) as "score"."""
         
         return prompt
     
@@ -70,10 +313,8 @@ Respond with ONLY the number (1-{batch_size}) of the best matching image, nothin
 
 2. "child": Determine if the person appears to be a child (under 18 years old) or an adult. Consider facial features, proportions, and overall appearance.
 
-Respond with ONLY a valid JSON object in this exact format:
-{"gender": "male/female", "child": "true/false"}
-
-Do not include any additional text, explanations, or formatting outside the JSON object."""
+Respond with a JSON object in this format:
+{"gender": "male/female", "child": true/false}"""
         
         return prompt
     
@@ -87,19 +328,15 @@ Do not include any additional text, explanations, or formatting outside the JSON
         Returns:
             Normalized string "true" or "false"
         """
-        if isinstance(value, bool):
-            return "true" if value else "false"
-        
         if isinstance(value, str):
             # Handle various string representations of boolean
-            value_lower = value.lower().strip()
-            if value_lower in ["true", "1", "yes", "on"]:
-                return "true"
-            elif value_lower in ["false", "0", "no", "off"]:
-                return "false"
+            value = value.lower().strip()
         
-        # Default to false for unknown values
-        return "false"
+        # Anything not recognized as true (including unhashable values) is false
+        try:
+            return "true" if value in _TRUE_VALUES else "false"
+        except TypeError:
+            return "false"
     
     def parse_gender_child_response(self, response_text: str) -> Dict[str, str]:
         """
@@ -115,35 +352,42 @@ Do not include any additional text, explanations, or formatting outside the JSON
             # Clean the response text
             cleaned_response = response_text.strip()
             
-            # Try to extract JSON from the response
-            # Look for JSON-like content between curly braces
-            json_match = re.search(r'\{[^}]*\}', cleaned_response)
-            if json_match:
-                json_str = json_match.group(0)
-                parsed_data = json.loads(json_str)
-                
-                # Normalize the values
+            # Schema-constrained responses are bare JSON, parsed in one pass
+            parsed_data = None
+            if cleaned_response.startswith('{'):
+                try:
+                    parsed_data = _json_loads(cleaned_response)
+                except ValueError:
+                    parsed_data = None
+            if not isinstance(parsed_data, dict):
+                # Otherwise look for JSON-like content between curly braces
+                json_match = _JSON_OBJECT_RE.search(cleaned_response)
+                parsed_data = _json_loads(json_match.group(0)) if json_match else None
+            if isinstance(parsed_data, dict):
+                # Normalize the values; the schema returns child as a real boolean
+                child = parsed_data.get("child", False)
                 result = {
                     "gender": str(parsed_data.get("gender", "unknown")).lower(),
-                    "child": self.normalize_boolean_string(parsed_data.get("child", False))
+                    "child": ("true" if child else "false") if isinstance(child, bool)
+                             else self.normalize_boolean_string(child)
                 }
                 
                 # Validate gender values
                 if result["gender"] not in ["male", "female"]:
                     result["gender"] = "unknown"
                 
-                print(f"Parsed gender/child data: {result}")
+                logger.debug("Parsed gender/child data: %s", result)
                 return result
             else:
                 # Fallback parsing if no JSON found
-                print("No JSON found in response, attempting fallback parsing")
+                logger.warning("No JSON found in response, attempting fallback parsing")
                 return self._fallback_parse_gender_child(response_text)
                 
         except json.JSONDecodeError as e:
-            print(f"JSON parsing error: {e}, attempting fallback parsing")
+            logger.warning("JSON parsing error: %s, attempting fallback parsing", e)
             return self._fallback_parse_gender_child(response_text)
         except Exception as e:
-            print(f"Error parsing gender/child response: {e}")
+            logger.warning("Error parsing gender/child response: %s", e)
             return {"gender": "unknown", "child": "false"}
     
     def _fallback_parse_gender_child(self, response_text: str) -> Dict[str, str]:
@@ -173,7 +417,7 @@ Do not include any additional text, explanations, or formatting outside the JSON
             child = "false"
         
         result = {"gender": gender, "child": child}
-        print(f"Fallback parsed gender/child data: {result}")
+        logger.debug("Fallback parsed gender/child data: %s", result)
         return result
     
     def get_gender_child_info_from_image(self, user_image: Image.Image) -> Dict[str, str]:
@@ -190,74 +434,238 @@ Do not include any additional text, explanations, or formatting outside the JSON
             # Create the prompt for gender and child detection
             prompt_text = self.create_gender_child_detection_prompt()
             
+            # Reuse the response for a perceptually identical photo and the same prompt
+            cache_key = (self.perceptual_hash(user_image), hashlib.md5(prompt_text.encode()).hexdigest())
+            response_text = self._get_cached_response(cache_key)
+            if response_text is not None:
+                logger.debug("Using cached gender/child response")
+                return self.parse_gender_child_response(response_text)
+            
             # Get raw LLM response
-            response_text = self.get_raw_llm_response(prompt_text, [user_image])
+            response_text = self.get_raw_llm_response(prompt_text, [user_image],
+                                                      response_schema=_GENDER_CHILD_SCHEMA)
             
-            # Parse the response
+            # Parse the response; only real answers are cached, so a malformed one is retried
             result = self.parse_gender_child_response(response_text)
+            if result["gender"] in ("male", "female"):
+                self._store_cached_response(cache_key, response_text)
             
             return result
             
         except Exception as e:
-            print(f"Error in gender/child detection: {e}")
+            logger.warning("Error in gender/child detection: %s", e)
             # Return default values on error
             return {"gender": "unknown", "child": "false"}
     
-    def get_raw_llm_response(self, prompt: str, images: Optional[List[Image.Image]] = None) -> str:
+    def _build_request(self, prompt: str,
+                       images: Optional[List[Union[Image.Image, bytes]]] = None,
+                       response_schema: Optional[types.Schema] = None) -> Tuple[types.Content, types.GenerateContentConfig]:
+        """
+        Build the request content and config for a prompt with optional images
+        
+        Args:
+            prompt: The text prompt to send to the LLM
+            images: Optional list of PIL Image objects or JPEG bytes to include in the request
+            response_schema: Optional schema the response must follow; the response is JSON when given
+            
+        Returns:
+            Tuple of (content, generate_content_config)
+        """
+        parts = []
+        
+        # Add images if provided
+        if images:
+            # Bytes are used as is; PIL images are encoded once and cached
+            for img in images:
+                img_bytes = img if isinstance(img, bytes) else self.encode_pil_image_to_jpeg_bytes(img)
+                parts.append(types.Part.from_bytes(
+                    mime_type="image/jpeg",
+                    data=img_bytes,
+                ))
+        
+        # Add text prompt
+        parts.append(types.Part.from_text(text=prompt))
+        
+        content = types.Content(
+            role="user",
+            parts=parts
+        )
+        
+        generate_content_config = types.GenerateContentConfig(
+            response_mime_type="application/json" if response_schema else "text/plain",
+            response_schema=response_schema,
+            thinking_config=types.ThinkingConfig(
+                thinking_budget=0
+            )
+        )
+        
+        return content, generate_content_config
+    
+    def _extract_response_text(self, response: Any) -> str:
+        """Extract the stripped text from an LLM response"""
+        response_text = response.text
+        if response_text is None:
+            raise ValueError("LLM response is empty")
+        response_text = response_text.strip()
+        logger.debug("LLM Response: %r", response_text)
+        return response_text
+    
+    def get_raw_llm_response(self, prompt: str, images: Optional[List[Union[Image.Image, bytes]]] = None,
+                             response_schema: Optional[types.Schema] = None,
+                             model_name: Optional[str] = None) -> str:
         """
         Get raw LLM response for any prompt with optional PIL images
         
         Args:
             prompt: The text prompt to send to the LLM
-            images: Optional list of PIL Image objects to include in the request
+            images: Optional list of PIL Image objects or JPEG bytes to include in the request
+            response_schema: Optional schema the response must follow; the response is JSON when given
+            model_name: Optional model override, defaults to self.model_name
             
         Returns:
             Raw text response from the LLM
         """
         try:
-            parts = []
-            
-            # Add images if provided
-            if images:
-                for img in images:
-                    img_base64 = self.encode_pil_image_to_base64(img)
-                    parts.append(types.Part.from_bytes(
-                        mime_type="image/jpeg",
-                        data=base64.b64decode(img_base64),
-                    ))
-            
-            # Add text prompt
-            parts.append(types.Part.from_text(text=prompt))
-            
-            content = types.Content(
-                role="user",
-                parts=parts
+            content, generate_content_config = self._build_request(prompt, images, response_schema)
+            
+            _rate_limiter.acquire()
+            response = self.client.models.generate_content(
+                model=model_name or self.model_name,
+                contents=content,
+                config=generate_content_config,
             )
             
-            generate_content_config = types.GenerateContentConfig(
-                response_mime_type="text/plain",
-                thinking_config=types.ThinkingConfig(
-                    thinking_budget=0
-                )
+            return self._extract_response_text(response)
+            
+        except Exception as e:
+            logger.warning("Error getting LLM response: %s", e)
+            raise
+    
+    async def get_raw_llm_response_async(self, prompt: str,
+                                         images: Optional[List[Union[Image.Image, bytes]]] = None,
+                                         response_schema: Optional[types.Schema] = None,
+                                         model_name: Optional[str] = None) -> str:
+        """
+        Async version of get_raw_llm_response using the client's async API
+        
+        Args:
+            prompt: The text prompt to send to the LLM
+            images: Optional list of PIL Image objects or JPEG bytes to include in the request
+            response_schema: Optional schema the response must follow; the response is JSON when given
+            model_name: Optional model override, defaults to self.model_name
+            
+        Returns:
+            Raw text response from the LLM
+        """
+        try:
+            content, generate_content_config = self._build_request(prompt, images, response_schema)
+            
+            await _rate_limiter.acquire_async()
+            response = await self.client.aio.models.generate_content(
+                model=model_name or self.model_name,
+                contents=content,
+                config=generate_content_config,
             )
             
-            response = self.client.models.generate_content(
-                model=self.model_name,
+            return self._extract_response_text(response)
+            
+        except Exception as e:
+            logger.warning("Error getting LLM response: %s", e)
+            raise
+    
+    def _parse_json_field(self, response_text: str, field: str) -> Any:
+        """Read a field from a schema-constrained JSON response, or None if the response isn't such JSON"""
+        try:
+            parsed = _json_loads(response_text)
+        except ValueError:
+            return None
+        return parsed.get(field) if isinstance(parsed, dict) else None
+    
+    def get_number_llm_response(self, prompt: str, images: Optional[List[Union[Image.Image, bytes]]] = None,
+                                response_schema: Optional[types.Schema] = None,
+                                model_name: Optional[str] = None) -> str:
+        """
+        Get an LLM response whose answer is a single number, streaming it and
+        stopping as soon as the number is complete
+        
+        Args:
+            prompt: The text prompt to send to the LLM
+            images: Optional list of PIL Image objects or JPEG bytes to include in the request
+            response_schema: Optional schema the response must follow; the response is JSON when given
+            model_name: Optional model override, defaults to self.model_name
+            
+        Returns:
+            Response text up to and including the number
+        """
+        try:
+            content, generate_content_config = self._build_request(prompt, images, response_schema)
+            
+            _rate_limiter.acquire()
+            stream = self.client.models.generate_content_stream(
+                model=model_name or self.model_name,
                 contents=content,
                 config=generate_content_config,
             )
+            response_text = ""
+            try:
+                for chunk in stream:
+                    response_text += chunk.text or ""
+                    if _COMPLETE_NUMBER_RE.search(response_text):
+                        break
+            finally:
+                # Closing the stream drops the connection, so the server stops decoding
+                if hasattr(stream, 'close'):
+                    stream.close()
             
-            # Extract the response text
-            response_text = response.text
-            if response_text is None:
-                raise ValueError("LLM response is empty")
             response_text = response_text.strip()
-            print(f"LLM Response: '{response_text}'")
+            logger.debug("LLM Response: %r", response_text)
+            return response_text
             
+        except Exception as e:
+            logger.warning("Error getting LLM response: %s", e)
+            raise
+    
+    async def get_number_llm_response_async(self, prompt: str,
+                                            images: Optional[List[Union[Image.Image, bytes]]] = None,
+                                            response_schema: Optional[types.Schema] = None,
+                                            model_name: Optional[str] = None) -> str:
+        """
+        Async version of get_number_llm_response
+        
+        Args:
+            prompt: The text prompt to send to the LLM
+            images: Optional list of PIL Image objects or JPEG bytes to include in the request
+            response_schema: Optional schema the response must follow; the response is JSON when given
+            model_name: Optional model override, defaults to self.model_name
+            
+        Returns:
+            Response text up to and including the number
+        """
+        try:
+            content, generate_content_config = self._build_request(prompt, images, response_schema)
+            
+            await _rate_limiter.acquire_async()
+            stream = await self.client.aio.models.generate_content_stream(
+                model=model_name or self.model_name,
+                contents=content,
+                config=generate_content_config,
+            )
+            response_text = ""
+            try:
+                async for chunk in stream:
+                    response_text += chunk.text or ""
+                    if _COMPLETE_NUMBER_RE.search(response_text):
+                        break
+            finally:
+                if hasattr(stream, 'aclose'):
+                    await stream.aclose()
+            
+            response_text = response_text.strip()
+            logger.debug("LLM Response: %r", response_text)
             return response_text
             
         except Exception as e:
-            print(f"Error getting LLM response: {e}")
+            logger.warning("Error getting LLM response: %s", e)
             raise
     
     def parse_number_from_response(self, response_text: str, max_number: int) -> int:
@@ -271,24 +679,182 @@ Do not include any additional text, explanations, or formatting outside the JSON
         Returns:
             Parsed number (1-based indexing)
         """
-        # Try to extract a number from the response (1 to max_number)
-        number_match = re.search(rf'\b([1-{max_number}])\b', response_text)
-        if number_match:
-            llm_selected_number = int(number_match.group(1))
-            print(f"LLM selected number: {llm_selected_number} (1-based)")
+        # Structured responses carry the number as {"choice": n}
+        choice = self._parse_json_field(response_text, "choice")
+        # bool is an int subclass, so {"choice": true} must not count as choice 1
+        if isinstance(choice, int) and not isinstance(choice, bool) and 1 <= choice <= max_number:
+            logger.debug("LLM selected number: %s (1-based)", choice)
+            return choice
+        
+        # Free-text fallback: a bare single digit is the common case
+        stripped = response_text.strip()
+        if len(stripped) == 1 and '1' <= stripped <= '9' and int(stripped) <= max_number:
+            llm_selected_number = int(stripped)
+            logger.debug("LLM selected number: %s (1-based)", llm_selected_number)
             return llm_selected_number
+        
+        # Otherwise take the first whole number in range (1 to max_number)
+        for number_match in _NUMBER_RE.finditer(response_text):
+            llm_selected_number = int(number_match.group(1))
+            if 1 <= llm_selected_number <= max_number:
+                logger.debug("LLM selected number: %s (1-based)", llm_selected_number)
+                return llm_selected_number
+        
+        # Fallback to first image if no number found
+        logger.warning("No valid number found in response, falling back to first image")
+        return 1
+    
+    def parse_numbers_from_response(self, response_text: str, max_number: int, k: int) -> List[int]:
+        """
+        Parse up to k distinct numbers from the LLM response, in the order given
+        
+        Args:
+            response_text: Raw response text from LLM
+            max_number: Maximum valid number (batch size)
+            k: Number of selections requested
+            
+        Returns:
+            List of exactly k distinct numbers (1-based indexing), padded in batch order if the LLM returned too few
+        """
+        choices = self._parse_json_field(response_text, "choices")
+        if not isinstance(choices, list):
+            # Free-text fallback
+            choices = [int(number_str) for number_str in _DIGITS_RE.findall(response_text)]
+        
+        selected_numbers = []
+        for number in choices:
+            if (isinstance(number, int) and not isinstance(number, bool)
+                    and 1 <= number <= max_number and number not in selected_numbers):
+                selected_numbers.append(number)
+                if len(selected_numbers) == k:
+                    break
+        
+        if len(selected_numbers) < k:
+            logger.warning("Only %s of %s valid numbers found in response, padding with first images", len(selected_numbers), k)
+            for number in range(1, max_number + 1):
+                if len(selected_numbers) == k:
+                    break
+                if number not in selected_numbers:
+                    selected_numbers.append(number)
+        
+        logger.debug("LLM selected numbers: %s (1-based)", selected_numbers)
+        return selected_numbers
+    
+    async def get_top_k_in_batch_async(self, user_image: Union[Image.Image, bytes],
+                                       batch_images: List[Union[Image.Image, bytes]], k: int = 3) -> List[int]:
+        """
+        Get the k best matching avatars from a batch of images
+        
+        Request errors are raised rather than answered with the first images,
+        so the caller can tell a fallback from a real pick.
+        
+        Args:
+            user_image: PIL Image of the user (or its JPEG bytes)
+            batch_images: List of PIL Image objects (or their JPEG bytes) of avatars to compare against
+            k: Number of avatars to select
+            
+        Returns:
+            List of k selected indices (0-based), best first
+        """
+        k = min(k, len(batch_images))
+        prompt_text = self.create_top_k_comparison_prompt(len(batch_images), k)
+        response_text = await self.get_raw_llm_response_async(prompt_text, [user_image] + batch_images,
+                                                              response_schema=_CHOICES_SCHEMA,
+                                                              model_name=self.selection_model_name)
+        return [number - 1 for number in self.parse_numbers_from_response(response_text, len(batch_images), k)]
+    
+    def parse_score_from_response(self, response_text: str) -> int:
+        """
+        Parse a 0-100 similarity score from the LLM response
+        
+        Args:
+            response_text: Raw response text from LLM
+            
+        Returns:
+            Parsed score clamped to 0-100, or 0 if no number was found
+        """
+        score = self._parse_json_field(response_text, "score")
+        if isinstance(score, int) and not isinstance(score, bool):
+            return max(0, min(score, 100))
+        
+        score_match = _SIGNED_INT_RE.search(response_text)
+        if score_match:
+            return max(0, min(int(score_match.group(0)), 100))
+        logger.warning("No score found in response, scoring 0")
+        return 0
+    
+    async def _score_pair_async(self, user_image: Union[Image.Image, bytes], avatar_image: Union[Image.Image, bytes],
+                                semaphore: asyncio.Semaphore) -> Optional[int]:
+        """Score a single avatar against the user image, or None if the request failed"""
+        async with semaphore:
+            try:
+                response_text = await self.get_raw_llm_response_async(
+                    self.create_pair_scoring_prompt(), [user_image, avatar_image],
+                    response_schema=_SCORE_SCHEMA, model_name=self.selection_model_name)
+                return self.parse_score_from_response(response_text)
+            except Exception as e:
+                logger.warning("Error scoring avatar: %s", e)
+                return None
+    
+    async def get_scores_async(self, user_image: Union[Image.Image, bytes],
+                               batch_images: List[Union[Image.Image, bytes]],
+                               max_concurrency: int = 8) -> List[Optional[int]]:
+        """
+        Score every avatar against the user image in parallel requests
+        
+        Each request carries only two images and returns a short score, so the
+        latency is that of the slowest single request rather than one long prompt.
+        
+        Args:
+            user_image: PIL Image of the user (or its JPEG bytes)
+            batch_images: List of PIL Image objects (or their JPEG bytes) of avatars to score
+            max_concurrency: Maximum number of scoring requests in flight at once
+            
+        Returns:
+            List of 0-100 scores in batch order, None where the request failed
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        scores = await asyncio.gather(
+            *[self._score_pair_async(user_image, avatar_image, semaphore) for avatar_image in batch_images]
+        )
+        logger.debug("Pairwise scores: %s", scores)
+        return scores
+    
+    def _select_from_response(self, response_text: str,
+                              batch_images: List[Union[Image.Image, bytes]]) -> Tuple[Union[Image.Image, bytes], int]:
+        """
+        Map an LLM batch comparison response to the selected image
+        
+        Args:
+            response_text: Raw response text from LLM
+            batch_images: The batch of avatar images that was compared
+            
+        Returns:
+            Tuple of (selected_image, selected_index) where index is 0-based
+        """
+        # Parse the number from response
+        llm_selected_number = self.parse_number_from_response(response_text, len(batch_images))
+        
+        # Convert 1-based to 0-based index
+        selected_index = llm_selected_number - 1
+        
+        if 0 <= selected_index < len(batch_images):
+            selected_image = batch_images[selected_index]
+            logger.debug("Selected image at index: %s", selected_index)
+            return selected_image, selected_index
         else:
-            # Fallback to first image if no number found
-            print(f"No valid number found in response, falling back to first image")
-            return 1
+            # Fallback to first image if invalid index
+            logger.warning("Invalid index %s, falling back to first image", selected_index)
+            return batch_images[0], 0
     
-    def get_best_match_in_batch(self, user_image: Image.Image, batch_images: List[Image.Image]) -> Tuple[Image.Image, int]:
+    def get_best_match_in_batch(self, user_image: Union[Image.Image, bytes],
+                                batch_images: List[Union[Image.Image, bytes]]) -> Tuple[Union[Image.Image, bytes], int]:
         """
         Get the best matching avatar from a batch of PIL images
         
         Args:
-            user_image: PIL Image of the user
-            batch_images: List of PIL Image objects of avatars to compare against
+            user_image: PIL Image of the user (or its JPEG bytes)
+            batch_images: List of PIL Image objects (or their JPEG bytes) of avatars to compare against
             
         Returns:
             Tuple of (selected_image, selected_index) where index is 0-based
@@ -301,27 +867,38 @@ Do not include any additional text, explanations, or formatting outside the JSON
             all_images = [user_image] + batch_images
             
             # Get raw LLM response
-            response_text = self.get_raw_llm_response(prompt_text, all_images)
-            
-            # Parse the number from response
-            llm_selected_number = self.parse_number_from_response(response_text, len(batch_images))
+            response_text = self.get_number_llm_response(prompt_text, all_images,
+                                                         response_schema=_CHOICE_SCHEMA,
+                                                         model_name=self.selection_model_name)
             
-            # Convert 1-based to 0-based index
-            selected_index = llm_selected_number - 1
-            
-            if 0 <= selected_index < len(batch_images):
-                selected_image = batch_images[selected_index]
-                print(f"Selected image at index: {selected_index}")
-                return selected_image, selected_index
-            else:
-                # Fallback to first image if invalid index
-                print(f"Invalid index {selected_index}, falling back to first image")
-                return batch_images[0], 0
+            return self._select_from_response(response_text, batch_images)
                 
         except Exception as e:
-            print(f"Error in batch comparison: {e}")
+            logger.warning("Error in batch comparison: %s", e)
             # Fallback to first image on error
             return batch_images[0], 0
+    
+    async def get_best_match_in_batch_async(self, user_image: Union[Image.Image, bytes],
+                                            batch_images: List[Union[Image.Image, bytes]]) -> Tuple[Union[Image.Image, bytes], int]:
+        """
+        Async version of get_best_match_in_batch, so many batches can be in flight at once
+        
+        Request errors are raised rather than answered with the first image,
+        so the caller can tell a fallback from a real pick.
+        
+        Args:
+            user_image: PIL Image of the user (or its JPEG bytes)
+            batch_images: List of PIL Image objects (or their JPEG bytes) of avatars to compare against
+            
+        Returns:
+            Tuple of (selected_image, selected_index) where index is 0-based
+        """
+        prompt_text = self.create_batch_comparison_prompt(len(batch_images))
+        all_images = [user_image] + batch_images
+        response_text = await self.get_number_llm_response_async(prompt_text, all_images,
+                                                                 response_schema=_CHOICE_SCHEMA,
+                                                                 model_name=self.selection_model_name)
+        return self._select_from_response(response_text, batch_images)
 
 def test_llm_service():
     """Test the in-memory LLM service"""
@@ -360,4 +937,5 @@ def test_llm_service():
         print("Not enough avatars found for testing")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     test_llm_service() 
\ No newline at end of file
@@ -1,13 +1,105 @@
 import streamlit as st
-import os
-import tempfile
+import hashlib
 from PIL import Image
 import time
-from avatar_match_pipeline_v2 import run_avatar_matching_v2
 import base64
 import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import io
+from typing import Final, TYPE_CHECKING
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# The pipeline and services pull in the Gemini SDK; they are imported on first use
+# so the upload page can render before that import cost is paid
+if TYPE_CHECKING:
+    from avatar_service import AvatarService
+    from in_memory_llm_service import InMemoryLLMService
+
+# Longest side of the uploaded photo handed to the matcher, which downscales further for the LLM
+UPLOAD_MAX_SIDE = 1024
+
+@st.cache_resource
+def _http() -> requests.Session:
+    """HTTP session shared by all sessions and reruns, so avatar fetches reuse pooled connections to the CDN"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                          max_retries=Retry(total=2, backoff_factor=0.2))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+@st.cache_resource
+def get_llm_service() -> "InMemoryLLMService":
+    """LLM service shared by all sessions and reruns, so the Gemini client is set up once"""
+    from in_memory_llm_service import InMemoryLLMService
+    return InMemoryLLMService()
+
+@st.cache_resource
+def get_avatar_service() -> "AvatarService":
+    """Avatar service shared by all sessions and reruns, so metadata is loaded once"""
+    from avatar_service import AvatarService
+    return AvatarService()
+
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
+def _fetch_avatar(url: str) -> bytes:
+    """Download avatar image bytes, cached per URL so reruns don't re-fetch them"""
+    response = _http().get(url, timeout=10)
+    response.raise_for_status()
+    return response.content
+
+@st.cache_data(show_spinner=False)
+def decode_upload(data: bytes, max_side: int = UPLOAD_MAX_SIDE) -> Image.Image:
+    """Decode uploaded image bytes to an RGB PIL image no larger than max_side, once per distinct upload"""
+    image = Image.open(io.BytesIO(data))
+    # Let libjpeg decode at reduced scale when the photo is much larger than needed (no-op for other formats)
+    image.draft('RGB', (max_side, max_side))
+    image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+    if image.mode != 'RGB':
+        return image.convert('RGB')
+    return image
+
+@st.cache_data(show_spinner=False)
+def _decode_preview(file_bytes: bytes, max_side: int = 250) -> bytes:
+    """Downscale the upload to a small JPEG for the preview, so reruns send kilobytes instead of the full photo"""
+    image = Image.open(io.BytesIO(file_bytes))
+    image.draft('RGB', (max_side, max_side))
+    image.thumbnail((max_side, max_side))
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=85)
+    return buffer.getvalue()
+
+class DegradedMatchError(Exception):
+    """Carries a match result built on LLM fallbacks out of match_avatar, so it is shown but not cached"""
+    
+    def __init__(self, result: dict):
+        super().__init__("Matching fell back after LLM errors")
+        self.result = result
+
+@st.cache_data(ttl=24 * 60 * 60, show_spinner=False)
+def match_avatar(image_sha: str, batch_size: int, top_k: int, pairwise_scoring: bool,
+                 _user_image: Image.Image) -> dict:
+    """Run the matching pipeline, memoized by the upload's content hash and the run settings"""
+    from avatar_match_pipeline_v2 import run_avatar_matching_v2
+    result = run_avatar_matching_v2(
+        user_image=_user_image,
+        batch_size=batch_size,
+        top_k=top_k,
+        pairwise_scoring=pairwise_scoring,
+        llm_service=get_llm_service(),
+        avatar_service=get_avatar_service()
+    )
+    # st.cache_data doesn't store results of calls that raise, so the next click runs the pipeline again
+    if result.get("degraded"):
+        raise DegradedMatchError(result)
+    return result
 
 # Page configuration
 st.set_page_config(
@@ -18,7 +110,7 @@ st.set_page_config(
 )
 
 # Custom CSS for better styling
-st.markdown("""
+CUSTOM_CSS: Final[str] = """
 <style>
     .main-header {
         text-align: center;
@@ -57,9 +149,12 @@ st.markdown("""
         color: #222;
     }
 </style>
-""", unsafe_allow_html=True)
+"""
 
 def main():
+    # Streamlit rebuilds the page on every rerun, so the styles are injected each time
+    st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
+    
     # Main header
     st.markdown('<h1 class="main-header">🎯 Smart Avatar Matcher</h1>', unsafe_allow_html=True)
     st.markdown("""
@@ -93,90 +188,104 @@ def show_main_page():
         help="Upload a clear photo of yourself. Our AI will detect your gender and age group to find the most suitable avatars."
     )
     
-    # Clear best match if a new file is uploaded
-    if 'last_uploaded_filename' not in st.session_state:
-        st.session_state.last_uploaded_filename = None
-    if uploaded_file is not None and uploaded_file.name != st.session_state.last_uploaded_filename:
-        st.session_state.last_result = None
-        st.session_state.last_uploaded_filename = uploaded_file.name
+    # Clear best match if a new file is uploaded; file_id is unique per upload, unlike the file name
+    if 'last_uploaded_file_id' not in st.session_state:
+        st.session_state.last_uploaded_file_id = None
+    if uploaded_file is not None:
+        upload_id = getattr(uploaded_file, 'file_id', None) or hashlib.md5(uploaded_file.getvalue()).hexdigest()
+        if upload_id != st.session_state.last_uploaded_file_id:
+            st.session_state.last_result = None
+            st.session_state.last_uploaded_file_id = upload_id
 
     # Batch size slider
     st.subheader("⚙️ Configuration")
     batch_size = st.slider(
         "Batch Size",
-        min_value=1,
+        min_value=2,
         max_value=16,
         value=4,
-        help="Number of avatars to compare at once. Higher values may be faster but less accurate."
+        help="Number of avatars to compare at once when more than 16 match your photo. 16 or fewer are always compared in a single request, so this only affects larger pools."
+    )
+    top_k = st.slider(
+        "Survivors per Batch",
+        min_value=1,
+        max_value=4,
+        value=1,
+        help="Number of avatars advancing from each batch until the final round. Only used when more than 16 avatars match your photo; higher values keep close runners-up alive, which pairs well with larger batch sizes."
+    )
+    pairwise_scoring = st.checkbox(
+        "Pairwise Scoring",
+        value=False,
+        help="Score every avatar against your photo once, all in parallel, instead of comparing them in batches. Batch size and survivors are ignored; one API call per avatar."
     )
     
     st.markdown('</div>', unsafe_allow_html=True)
     
     # Process button
     if uploaded_file is not None:
+        # Create the LLM service now so its connection warms up before the match is started;
+        # a missing API key is reported by process_image instead
+        try:
+            get_llm_service()
+        except ValueError:
+            pass
+        
         # Display uploaded image and (if available) best match side by side
         col1, col2 = st.columns(2)
         with col1:
             st.subheader("Uploaded Image")
-            image = Image.open(uploaded_file)
-            st.image(image, caption="Uploaded Image", width=250)
+            st.image(_decode_preview(uploaded_file.getvalue()), caption="Uploaded Image", width=250)
         with col2:
-            if 'last_result' in st.session_state and st.session_state.last_result is not None and 'best_match_metadata' in st.session_state.last_result:
-                metadata = st.session_state.last_result['best_match_metadata']
-                public_url = metadata.get('public_url')
-                if public_url:
-                    try:
-                        response = requests.get(public_url, timeout=10)
-                        response.raise_for_status()
-                        avatar_img = Image.open(io.BytesIO(response.content))
-                        st.subheader("Best Match Avatar")
-                        st.image(avatar_img, width=250)
-                    except Exception as e:
-                        st.error(f"Could not load avatar image: {e}")
+            best_match_placeholder = st.empty()
         # Show processing time below the images if available
-        if 'last_result' in st.session_state and st.session_state.last_result is not None and 'best_match_metadata' in st.session_state.last_result and 'last_processing_time' in st.session_state:
-            st.markdown(f'<div style="text-align:center; color:#888; margin-top:1rem;">Processing time: {st.session_state.last_processing_time:.2f}s</div>', unsafe_allow_html=True)
+        time_placeholder = st.empty()
+        render_best_match(best_match_placeholder, time_placeholder, st.session_state.get('last_result'),
+                          st.session_state.get('last_processing_time'))
         # Process button
         if st.button("🎯 Find Best Avatar Match", type="primary"):
-            process_image(uploaded_file, batch_size)
+            result = process_image(uploaded_file, batch_size, min(top_k, batch_size - 1), pairwise_scoring)
+            # Fill the placeholders in this run instead of rerunning the whole script
+            if result is not None:
+                render_best_match(best_match_placeholder, time_placeholder, result,
+                                  st.session_state.last_processing_time)
+
+def render_best_match(best_match_placeholder, time_placeholder, result, processing_time=None):
+    """Render the best match avatar and processing time of a result into their placeholders"""
+    if not result or not result.get('best_match_metadata'):
+        return
+    public_url = result['best_match_metadata'].get('public_url')
+    if public_url:
+        with best_match_placeholder.container():
+            try:
+                avatar_img = Image.open(io.BytesIO(_fetch_avatar(public_url)))
+                st.subheader("Best Match Avatar")
+                st.image(avatar_img, width=250)
+            except Exception as e:
+                st.error(f"Could not load avatar image: {e}")
+    if processing_time is not None:
+        time_placeholder.markdown(f'<div style="text-align:center; color:#888; margin-top:1rem;">Processing time: {processing_time:.2f}s</div>', unsafe_allow_html=True)
 
-def process_image(uploaded_file, batch_size):
-    """Process the uploaded image and find the best avatar match"""
+def process_image(uploaded_file, batch_size, top_k=1, pairwise_scoring=False):
+    """Process the uploaded image and find the best avatar match, returning the result or None on failure"""
     
-    # Create a progress bar
-    progress_bar = st.progress(0)
-    status_text = st.empty()
+    # One status container for the whole run; intermediate progress can't repaint while the pipeline blocks
+    status = st.status("🎯 Matching avatars...", expanded=False)
     
     # Start timing
     start_time = time.time()
     
     try:
-        # Save uploaded file to temporary location
-        status_text.text("Saving uploaded image...")
-        progress_bar.progress(10)
-        
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.png') as tmp_file:
-            # Convert to RGB if necessary and save as PNG
-            image = Image.open(uploaded_file)
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            image.save(tmp_file.name, 'PNG')
-            temp_image_path = tmp_file.name
-        
-        status_text.text("Initializing avatar matching...")
-        progress_bar.progress(20)
-        
-        # Run the new avatar matching pipeline
-        status_text.text("Processing avatars...")
-        progress_bar.progress(40)
-        
-        result = run_avatar_matching_v2(
-            user_image_path=temp_image_path,
-            batch_size=batch_size
-        )
-        
-        progress_bar.progress(90)
-        status_text.text("Finalizing results...")
+        with status:
+            # Decode the upload (cached) and hand it to the pipeline in memory
+            image_bytes = uploaded_file.getvalue()
+            image = decode_upload(image_bytes)
+            image_sha = hashlib.sha256(image_bytes).hexdigest()
+            
+            # A byte-identical re-upload with the same settings returns the earlier result
+            try:
+                result = match_avatar(image_sha, batch_size, top_k, pairwise_scoring, image)
+            except DegradedMatchError as e:
+                result = e.result
         
         # Calculate total time
         end_time = time.time()
@@ -186,26 +295,29 @@ def process_image(uploaded_file, batch_size):
         st.session_state.last_result = result
         st.session_state.last_processing_time = total_time
         
-        progress_bar.progress(100)
-        status_text.text(f"✅ Matching complete! (Time: {total_time:.2f}s)")
-        
-        # Clean up temporary file
-        os.unlink(temp_image_path)
+        status.update(label=f"✅ Matching complete! (Time: {total_time:.2f}s)", state="complete")
+        if result.get("degraded"):
+            st.warning("⚠️ Some AI requests failed, so this match may not be the best one. Click the button again to retry.")
         
-        # Rerun to update UI and show best match
-        st.rerun()
+        return result
         
     except Exception as e:
         st.error(f"❌ Error during processing: {str(e)}")
-        progress_bar.progress(0)
-        status_text.text("Processing failed")
+        status.update(label="Processing failed", state="error")
+        return None
+
+def dump_result_json(result) -> bytes:
+    """Serialize a match result as indented JSON, with orjson when it is available"""
+    if orjson is not None:
+        return orjson.dumps(result, option=orjson.OPT_INDENT_2)
+    return json.dumps(result, indent=2).encode('utf-8')
 
 def show_visualization_page():
     """Page for tournament visualization"""
     
     st.subheader("🏆 Tournament Visualization")
     
-    if 'last_result' not in st.session_state:
+    if not st.session_state.get('last_result'):
         st.warning("⚠️ No matching results available. Please run a match on the main page first.")
         return
     
@@ -217,26 +329,27 @@ def show_visualization_page():
     elimination_history = result.get('elimination_history', [])
     
     if elimination_history:
+        # Build every round's box into one markdown element rather than one element per round
+        round_boxes = []
         for round_data in elimination_history:
             round_num = round_data["round"]
             candidates = round_data["candidates"]
             winners = round_data["winners"]
             
-            st.markdown(f"""
-            <div class="stats-box">
-                <h4>🏆 Round {round_num}</h4>
-                <p><strong>Candidates:</strong> {len(candidates)}</p>
-                <p><strong>Winners:</strong> {len(winners)}</p>
-                <p><strong>Winner IDs:</strong> {', '.join(winners[:5])}{'...' if len(winners) > 5 else ''}</p>
-            </div>
-            """, unsafe_allow_html=True)
+            round_boxes.append(f"""<div class="stats-box">
+    <h4>🏆 Round {round_num}</h4>
+    <p><strong>Candidates:</strong> {len(candidates)}</p>
+    <p><strong>Winners:</strong> {len(winners)}</p>
+    <p><strong>Winner IDs:</strong> {', '.join(winners[:5])}{'...' if len(winners) > 5 else ''}</p>
+</div>""")
+        st.markdown("\n".join(round_boxes), unsafe_allow_html=True)
     else:
         st.warning("No elimination history available for visualization.")
     
-    # Download button for the results
+    # Download button for the results; the JSON is only serialized when the button is clicked
     st.download_button(
         label="📥 Download Results as JSON",
-        data=json.dumps(result, indent=2),
+        data=lambda: dump_result_json(result),
         file_name="avatar_match_result.json",
         mime="application/json"
     )